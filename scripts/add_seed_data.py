@@ -18,21 +18,27 @@ args = parser.parse_args()
 
 fake = faker.Faker()
 
-init_db(args.db_file)
+db = init_db(args.db_file)
 
-for _ in range(args.count):
-    age = random.randrange(int(timedelta(days=50).total_seconds()))
-    user = User.create(
-        user_id="".join(random.choices("0123456789ABCDEF", k=16)),
-        username=fake.name().lower(),
-    )
-    plant = Plant(
-        user=user,
-        user_active=user,
-        score=random.randrange(age // 2, age),
-        created_at=datetime.now() - timedelta(seconds=age),
-        watered_at=datetime.now() - timedelta(seconds=random.randrange(2 * 24 * 60 * 60)),
-    )
-    plant.refresh()
-    plant.save()
-    print(f"Generated {user.username}'s {plant.description}")
+now = datetime.now()
+max_age = 50 * 24 * 60 * 60
+max_watered_age = 2 * 24 * 60 * 60
+
+# Commit everything in one transaction instead of one per row
+with db.atomic():
+    for _ in range(args.count):
+        age = random.randrange(max_age)
+        user = User.create(
+            user_id="".join(random.choices("0123456789ABCDEF", k=16)),
+            username=fake.name().lower(),
+        )
+        plant = Plant(
+            user=user,
+            user_active=user,
+            score=random.randrange(age // 2, age),
+            created_at=now - timedelta(seconds=age),
+            watered_at=now - timedelta(seconds=random.randrange(max_watered_age)),
+        )
+        plant.refresh()
+        plant.save()
+        print(f"Generated {user.username}'s {plant.description}")
@@ -48,7 +48,7 @@ for index in range(0, len(art_files), args.grid):
 
     title = ""
     max_height = max(len(art.character_matrix) for art in art_line)
-    lines = [""] * max_height
+    lines: list[list[str]] = [[] for _ in range(max_height)]
     for art in art_line:
         width, height = len(art.character_matrix[0]), len(art.character_matrix)
         if args.title:
@@ -58,10 +58,10 @@ for index in range(0, len(art_files), args.grid):
         title += title_text.center(width)
         text = art.render(ansi_enabled=True)
         for i, line in enumerate(text.splitlines()):
-            lines[i] += line.strip("\r\n")
+            lines[i].append(line.strip("\r\n"))
         for h in range(height, max_height):
-            lines[h] += " " * width
+            lines[h].append(" " * width)
 
-    print("\n".join(lines))
+    print("\n".join("".join(line) for line in lines))
     print(title)
     print("")
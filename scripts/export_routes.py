@@ -2,11 +2,11 @@ import re
 
 from astrobotany import app
 
-match_re = re.compile(r"\(\?P<(.+)>.+\)")
+match_re = re.compile(r"\(\?P<([^>]+)>[^)]*\)")
 
-paths = []
-for route, _ in app.routes:
-    paths.append(match_re.sub(r"{\g<1>}", route.path) or "/")
+paths = [path or "/" for path in app.exact_routes]
+for _prefix, pattern, _func in app.pattern_routes:
+    paths.append(match_re.sub(r"{\g<1>}", pattern.pattern))
 
 for path in sorted(paths):
     print(path)
@@ -7,17 +7,12 @@ from astrobotany.items import Badge
 
 taken = {badge.badge_symbol for badge in Badge._badges}  # noqa
 
-choices = []
-for name, char in get_emoji_unicode_dict("en").items():
-    # Stick to "simple" emojis
-    if len(char) > 1:
-        continue
-
-    # No duplicates
-    if char in taken:
-        continue
-
-    choices.append((name, char))
+# Stick to "simple" emojis, no duplicates
+choices = [
+    (name, char)
+    for name, char in get_emoji_unicode_dict("en").items()
+    if len(char) == 1 and char not in taken
+]
 
 
 random.shuffle(choices)
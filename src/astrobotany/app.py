@@ -1,11 +1,14 @@
+import math
 import os
+import re
+import time
 import typing
-from functools import lru_cache
+from collections import deque
 
 import emoji
 import jinja2
 from jetforce import JetforceApplication, Request, Response, Status
-from jetforce.app.base import EnvironDict, RouteHandler, RoutePattern
+from jetforce.app.base import DeferredResponse, EnvironDict, RouteHandler, RoutePattern
 
 from astrobotany.models import Certificate, User
 from astrobotany.utils import ordinal_format
@@ -13,6 +16,22 @@ from astrobotany.utils import ordinal_format
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
 
+WEEKDAY_NAMES = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+MONTH_NAMES = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+
 
 def setup_template_environment():
     template_env = jinja2.Environment(
@@ -20,16 +39,27 @@ def setup_template_environment():
         undefined=jinja2.StrictUndefined,
         trim_blocks=True,
         lstrip_blocks=True,
+        auto_reload=False,
     )
 
-    def datetime_format(value, fmt="%A, %B %d, %Y %-I:%M:%S %p"):
-        return value.strftime(fmt)
+    def datetime_format(value, fmt=None):
+        if fmt is not None:
+            return value.strftime(fmt)
+
+        # Hand-rolled version of "%A, %B %d, %Y %-I:%M:%S %p", which is
+        # rendered many times per page and is much slower with strftime()
+        hour = value.hour % 12 or 12
+        meridiem = "AM" if value.hour < 12 else "PM"
+        return (
+            f"{WEEKDAY_NAMES[value.weekday()]}, {MONTH_NAMES[value.month - 1]} "
+            f"{value.day:02d}, {value.year} {hour}:{value.minute:02d}:{value.second:02d} {meridiem}"
+        )
 
     def number_format(value):
         return f"{value:,}"
 
-    def humanize_timedelta(value):
-        minutes = int(value.total_seconds() // 60)
+    def humanize_minutes(value):
+        minutes = int(value)
         if minutes == 1:
             return "1 minute"
         elif minutes < 60:
@@ -44,15 +74,35 @@ def setup_template_environment():
     template_env.filters["datetime"] = datetime_format
     template_env.filters["number"] = number_format
     template_env.filters["ordinal"] = ordinal_format
-    template_env.filters["humanize_timedelta"] = humanize_timedelta
+    template_env.filters["humanize_minutes"] = humanize_minutes
 
     return template_env
 
 
 _template_env = setup_template_environment()
 
+# Every template is compiled once here at import, and requests call the bound
+# render methods directly instead of going through Environment.get_template().
+# All of the templates are .gmi files, so there's nothing left to load lazily.
+_renderers: dict[str, typing.Callable[..., str]] = {
+    name: _template_env.get_template(name).render
+    for name in _template_env.list_templates(extensions=["gmi"])
+}
+
+# Post-processing applied to rendered templates for each emoji_mode setting,
+# the default mode 0 leaves the text untouched
+EMOJI_FILTERS: dict[int, typing.Callable[[str], str]] = {
+    1: emoji.demojize,
+    2: emoji.replace_emoji,
+}
+
+SESSION_MAX_SIZE = 4096
+SESSION_TTL = 60 * 60
+
+# Sessions keyed by ID, ordered from least to most recently accessed
+_sessions: dict[str, tuple[float, dict]] = {}
+
 
-@lru_cache(2048)
 def load_session(session_id: str) -> dict:
     """
     A poor man's server-side session object.
@@ -60,15 +110,96 @@ def load_session(session_id: str) -> dict:
     Stores session data as a dict in memory that will be wiped on server
     restart. Mutate the dictionary to update the session. This only works
     because the server is running as a single process with shared memory.
+
+    Sessions expire after an hour of inactivity, and the least recently used
+    sessions are dropped when there are too many.
+    """
+    now = time.monotonic()
+    entry = _sessions.pop(session_id, None)
+    if entry is None or now - entry[0] > SESSION_TTL:
+        session: dict = {}
+    else:
+        session = entry[1]
+
+    # Re-inserting moves the session to the end of the dict
+    _sessions[session_id] = (now, session)
+
+    while _sessions:
+        oldest_id, (last_access, _) = next(iter(_sessions.items()))
+        if len(_sessions) > SESSION_MAX_SIZE or now - last_access > SESSION_TTL:
+            del _sessions[oldest_id]
+        else:
+            break
+
+    return session
+
+
+class RateLimiter:
+    """
+    A sliding window rate limiter keyed on the client's IP address.
+
+    Rates are defined as strings like "10/5m" (10 requests per 5 minutes).
+    Unlike the fixed buckets in jetforce's limiter, idle clients are evicted
+    periodically so memory stays bounded by the number of active clients.
+
+    This differs from jetforce's limiter in a few ways:
+    - "h" periods are multiplied out (jetforce added 3600 seconds, so "2/4h"
+      was really a ~1 hour window)
+    - the window slides with each client's hits instead of resetting globally
+    - rejected requests are not counted against the client
     """
-    return {}
+
+    RATE_RE = re.compile(r"(?P<number>[0-9]+)/(?P<period>[0-9]+)?(?P<unit>[smhd])")
+    UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+    EVICT_INTERVAL = 1000
+
+    def __init__(self, rate: str) -> None:
+        match = self.RATE_RE.fullmatch(rate)
+        if match is None:
+            raise ValueError(f"Invalid rate: {rate}")
+
+        self.capacity = int(match["number"])
+        self.period = int(match["period"] or 1) * self.UNITS[match["unit"]]
+        self.hits: dict[str, deque[float]] = {}
+        self.check_count = 0
+
+    def check(self, request: Request) -> Response | None:
+        """
+        Record a hit and return a SLOW_DOWN response if the limit was exceeded.
+        """
+        now = time.monotonic()
+        cutoff = now - self.period
+
+        hits = self.hits.setdefault(request.environ["REMOTE_ADDR"], deque())
+        while hits and hits[0] <= cutoff:
+            hits.popleft()
+
+        self.check_count += 1
+        if self.check_count % self.EVICT_INTERVAL == 0:
+            self.evict(cutoff)
+
+        if len(hits) >= self.capacity:
+            retry_after = math.ceil(hits[0] - cutoff)
+            return Response(Status.SLOW_DOWN, str(retry_after))
+
+        hits.append(now)
+        return None
+
+    def evict(self, cutoff: float) -> None:
+        """
+        Drop clients that have no hits remaining inside the window.
+        """
+        for key in list(self.hits):
+            hits = self.hits.get(key)
+            if hits is not None and (not hits or hits[-1] <= cutoff):
+                del self.hits[key]
 
 
 def render_template(name: str, *args, **kwargs) -> str:
     """
     Render a gemini directory using the Jinja2 template engine.
     """
-    return _template_env.get_template(name).render(*args, **kwargs)
+    return _renderers[name](*args, **kwargs)
 
 
 class AuthenticatedRequest(Request):
@@ -89,11 +220,12 @@ class AuthenticatedRequest(Request):
     def render_template(self, name: str, *args, **kwargs) -> str:
         kwargs["request"] = self
         text = render_template(name, *args, **kwargs)
-        if self.cert.emoji_mode == 1:
-            text = emoji.demojize(text)
-        elif self.cert.emoji_mode == 2:
-            text = emoji.replace_emoji(text)  # type: ignore
-        return text
+        emoji_filter = EMOJI_FILTERS.get(self.cert.emoji_mode)
+        if emoji_filter is None or text.isascii():
+            # Every emoji contains a non-ASCII codepoint, so plain ASCII
+            # pages can skip the emoji scan entirely
+            return text
+        return emoji_filter(text)
 
 
 def authenticated_route(func: RouteHandler) -> RouteHandler:
@@ -102,17 +234,17 @@ def authenticated_route(func: RouteHandler) -> RouteHandler:
     """
 
     def wrapped(request: Request, **kwargs) -> Response:
-        if "REMOTE_USER" not in request.environ:
+        environ = request.environ
+        if "REMOTE_USER" not in environ:
             msg = "Attach your client certificate to continue."
             return Response(Status.CLIENT_CERTIFICATE_REQUIRED, msg)
 
-        if request.environ["TLS_CLIENT_AUTHORISED"]:
+        if environ["TLS_CLIENT_AUTHORISED"]:
             # Old-style verified certificate
-            serial_number = request.environ["TLS_CLIENT_SERIAL_NUMBER"]
-            fingerprint = f"{serial_number:032X}"  # Convert to hex
+            fingerprint = f"{environ['TLS_CLIENT_SERIAL_NUMBER']:032X}"  # Convert to hex
         else:
             # New-style self signed certificate
-            fingerprint = typing.cast(str, request.environ["TLS_CLIENT_HASH_B64"])
+            fingerprint = typing.cast(str, environ["TLS_CLIENT_HASH_B64"])
 
         cert = User.login(fingerprint)
         if cert is None:
@@ -120,27 +252,125 @@ def authenticated_route(func: RouteHandler) -> RouteHandler:
                 "register.gmi",
                 request=request,
                 fingerprint=fingerprint,
-                cert=request.environ["client_certificate"],
+                cert=environ["client_certificate"],
             )
             return Response(Status.SUCCESS, "text/gemini", body)
 
-        request = AuthenticatedRequest(request.environ, cert)
-        response = func(request, **kwargs)
-        return response
+        return func(AuthenticatedRequest(environ, cert), **kwargs)
 
     return wrapped
 
 
 class AstrobotanyApplication(JetforceApplication):
+    """
+    Jetforce application that dispatches to its own route table.
+
+    Jetforce tries every route pattern in turn, which adds up with this many
+    views. Instead, a single catch-all route is registered with jetforce that
+    looks up plain paths in a dict. Regex patterns are bucketed by the first
+    two path segments that they match literally (e.g. "/app/visit/"), so only
+    the patterns that could possibly match a request are tried.
+    """
+
+    REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+    PREFIX_DEPTH = 2
+
+    def __init__(self, *args: typing.Any, **kwargs: typing.Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.exact_routes: dict[str, RouteHandler] = {}
+        self.pattern_routes: list[tuple[tuple[str, ...], re.Pattern, RouteHandler]] = []
+        self.pattern_buckets: dict[tuple[str, ...], list[tuple[re.Pattern, RouteHandler]]] = {
+            (): []
+        }
+        self.routes.append((RoutePattern(".*"), self.dispatch))
+
+    def dispatch(self, request: Request) -> Response | DeferredResponse:
+        """
+        Route the request to the handler for its path.
+
+        Plain paths always take precedence over regex patterns, regardless of
+        the order they were registered in. Among the regex patterns, the one
+        registered last wins, like in jetforce.
+        """
+        path = request.path.rstrip("/")
+        func = self.exact_routes.get(path)
+        if func is not None:
+            return func(request)
+
+        prefix = tuple(path.split("/")[1 : self.PREFIX_DEPTH + 1])
+        while prefix not in self.pattern_buckets:
+            prefix = prefix[:-1]
+
+        for pattern, func in self.pattern_buckets[prefix]:
+            match = pattern.fullmatch(path)
+            if match:
+                return func(request, **match.groupdict())
+
+        return Response(Status.NOT_FOUND, "Not Found")
+
+    def get_route_prefix(self, path: str) -> tuple[str, ...]:
+        """
+        Return the leading path segments that a route pattern matches literally.
+        """
+        prefix: list[str] = []
+        for segment in path.split("/")[1:-1]:
+            if len(prefix) == self.PREFIX_DEPTH or not self.REGEX_CHARS.isdisjoint(segment):
+                break
+            prefix.append(segment)
+        return tuple(prefix)
+
+    def add_route(self, path: str, func: RouteHandler) -> None:
+        if self.REGEX_CHARS.isdisjoint(path):
+            self.exact_routes[path] = func
+            return
+
+        # Routes registered later take precedence, like in jetforce
+        self.pattern_routes.insert(0, (self.get_route_prefix(path), re.compile(path), func))
+
+        # Each bucket also holds the patterns with a shorter prefix that could
+        # match the same paths, so a request only ever needs to check one bucket
+        prefixes = {prefix for prefix, _, _ in self.pattern_routes} | {()}
+        self.pattern_buckets = {
+            prefix: [
+                (pattern, func)
+                for route_prefix, pattern, func in self.pattern_routes
+                if prefix[: len(route_prefix)] == route_prefix
+            ]
+            for prefix in prefixes
+        }
+
+    def route(
+        self,
+        path: str = ".*",
+        scheme: str = "gemini",
+        hostname: str | None = None,
+        strict_hostname: bool = True,
+        strict_port: bool = True,
+        strict_trailing_slash: bool = False,
+    ) -> typing.Callable[[RouteHandler], RouteHandler]:
+        """
+        Jetforce route decorator.
+
+        Only the path is matched by dispatch(), so the other jetforce routing
+        options must be left at their defaults.
+        """
+        routing_options = (scheme, hostname, strict_hostname, strict_port, strict_trailing_slash)
+        if routing_options != ("gemini", None, True, True, False):
+            raise ValueError("Only path based routing is supported")
+
+        def wrap(func: RouteHandler) -> RouteHandler:
+            self.add_route(path, func)
+            return func
+
+        return wrap
+
     def auth_route(self, path: str = ".*") -> typing.Callable[[RouteHandler], RouteHandler]:
         """
         Jetforce route decorator with an added authentication layer.
         """
-        route_pattern = RoutePattern(path)
 
         def wrap(func: RouteHandler) -> RouteHandler:
-            authenticated_func = authenticated_route(func)
-            app.routes.append((route_pattern, authenticated_func))
+            self.add_route(path, authenticated_route(func))
             return func
 
         return wrap
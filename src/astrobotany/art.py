@@ -1,5 +1,4 @@
 import functools
-import itertools
 import json
 import os
 from typing import NamedTuple
@@ -16,17 +15,29 @@ class Tile(NamedTuple):
 CharacterMatrix = list[list[Tile]]
 
 
+# Escape sequences for every color in the ansi-240 palette, which starts after
+# the 16 system colors, built once instead of formatted for each tile
+FG_CODES = tuple(f"\033[38;5;{code + 15}m" for code in range(241))
+BG_CODES = tuple(f"\033[48;5;{code + 15}m" for code in range(241))
+
+
 def colorize(text: str, fg: ColorCode = None, bg: ColorCode = None) -> str:
     """
     Colorize a line of text using the ansi-240 color palette.
     """
-    if fg is not None:
-        text = f"\033[38;5;{fg+15}m" + text
-    if bg is not None:
-        text = f"\033[48;5;{bg+15}m" + text
-    if fg is not None or bg is not None:
-        text = text + "\033[0m"
-    return text
+    # Negative codes would otherwise index from the end of the tables
+    if fg is not None and not 0 <= fg < len(FG_CODES):
+        raise ValueError(f"Invalid foreground color code: {fg}")
+    if bg is not None and not 0 <= bg < len(BG_CODES):
+        raise ValueError(f"Invalid background color code: {bg}")
+
+    if fg is None:
+        if bg is None:
+            return text
+        return f"{BG_CODES[bg]}{text}\033[0m"
+    elif bg is None:
+        return f"{FG_CODES[fg]}{text}\033[0m"
+    return f"{BG_CODES[bg]}{FG_CODES[fg]}{text}\033[0m"
 
 
 class ArtFile:
@@ -74,7 +85,7 @@ class ArtFile:
 
     # Making this a class-level variable has the effect of introducing some
     # randomness to the order of colors for rainbow plants
-    rainbow_generator = itertools.cycle(RAINBOW_COLORS)
+    rainbow_index = 0
 
     def __init__(self, filename: str, flower_color: str | None = None) -> None:
         self.filename = filename
@@ -82,9 +93,13 @@ class ArtFile:
         self.character_matrix = self.load_file(filename)
 
     @classmethod
+    @functools.lru_cache(maxsize=256)
     def load_file(cls, filename: str) -> CharacterMatrix:
         """
         Load a playscii file and build a matrix of characters representing the scene.
+
+        The parsed matrix is cached and shared between every color and ANSI
+        variant of the file, so it must not be modified.
         """
         with open(os.path.join(cls.ART_DIR, filename)) as fp:
             playscii_data = json.load(fp)
@@ -163,7 +178,9 @@ class ArtFile:
     @classmethod
     def get_flower_color_code(cls, flower_color: str, secondary: bool = False):
         if flower_color == "rainbow":
-            return next(cls.rainbow_generator)
+            code = cls.RAINBOW_COLORS[cls.rainbow_index]
+            cls.rainbow_index = (cls.rainbow_index + 1) % len(cls.RAINBOW_COLORS)
+            return code
         elif secondary:
             return cls.FLOWER_COLORS[flower_color][1]
         else:
@@ -194,6 +211,37 @@ class ArtFile:
         return new_matrix
 
 
-@functools.lru_cache(maxsize=1000)
+@functools.lru_cache(maxsize=256)
+def has_flower_tiles(filename: str) -> bool:
+    """
+    Check if an art file contains any tiles that are painted with the flower color.
+    """
+    flower_codes = (ArtFile.DEFAULT_COLOR_PRIMARY, ArtFile.DEFAULT_COLOR_SECONDARY)
+    return any(tile.fg in flower_codes for row in ArtFile.load_file(filename) for tile in row)
+
+
 def render_art(filename: str, flower_color: str | None = None, ansi_enabled: bool = False) -> str:
+    """
+    Render an art file, memoized on the arguments that affect the output.
+
+    The flower color only changes the ANSI rendering of files that contain
+    flower tiles, so it's dropped from the cache key otherwise. This keeps the
+    cache small enough that plant art can't evict the menu and title art.
+    """
+    if not ansi_enabled or not has_flower_tiles(filename):
+        flower_color = None
+    return _render_art(filename, flower_color, ansi_enabled)
+
+
+@functools.lru_cache(maxsize=1000)
+def _render_art(filename: str, flower_color: str | None, ansi_enabled: bool) -> str:
     return ArtFile(filename, flower_color).render(ansi_enabled)
+
+
+def prerender_art(*filenames: str) -> None:
+    """
+    Fill the render cache for art files that don't depend on a plant color.
+    """
+    for filename in filenames:
+        for ansi_enabled in (False, True):
+            render_art(filename, ansi_enabled=ansi_enabled)
@@ -19,24 +19,27 @@ POND_TEMPLATE = """\
        ~~~~~~
 """
 
+# Tiles are immutable, so every blank cell can share the same instance
+EMPTY_TILE = Tile(" ", None, None)
+
+# Offsets around a koi's head that must all be water, (y, x)
+KOI_NEIGHBORHOOD = tuple(itertools.product(range(-1, 2), range(-1, 4)))
+
 
 def initialize_canvas(height: int, width: int) -> tuple[CharacterMatrix, Coordinates]:
-    matrix: CharacterMatrix = []
-    empty: Coordinates = []
-    for y in range(height):
-        matrix.append([])
-        for x in range(width):
-            matrix[-1].append(Tile(" ", None, None))
-            empty.append((y, x))
-
-    empty.reverse()
+    matrix: CharacterMatrix = [[EMPTY_TILE] * width for _ in range(height)]
+
+    # Reversed so that empty.pop() hands out cells starting from the top-left
+    empty: Coordinates = [
+        (y, x) for y in range(height - 1, -1, -1) for x in range(width - 1, -1, -1)
+    ]
     return matrix, empty
 
 
 def get_plant_tile(plant: Plant) -> Tile:
     watered_delta = datetime.now() - plant.watered_at
     if plant.dead:
-        return Tile(" ", None, None)
+        return EMPTY_TILE
 
     char = [".", ",", "o", "O", "@", "&"][plant.stage]
     if watered_delta > timedelta(days=2):
@@ -54,7 +57,8 @@ def get_plant_tile(plant: Plant) -> Tile:
 
 
 def paint_plants(matrix: CharacterMatrix, empty: Coordinates, update_users: bool) -> None:
-    for user in User.select():
+    moved_users = []
+    for user in User.select_with_plant().order_by(User.id):
         symbol = get_plant_tile(user.plant)
         y, x = empty.pop()
         matrix[y][x] = symbol
@@ -62,7 +66,11 @@ def paint_plants(matrix: CharacterMatrix, empty: Coordinates, update_users: bool
             new_coordinates = f"{y} South, {x} East"
             if new_coordinates != user.garden_coordinates:
                 user.garden_coordinates = new_coordinates
-                user.save()
+                moved_users.append(user)
+
+    if moved_users:
+        with User._meta.database.atomic():
+            User.bulk_update(moved_users, fields=[User.garden_coordinates], batch_size=100)
 
 
 def paint_pond(
@@ -75,7 +83,10 @@ def paint_pond(
             if char != " ":
                 matrix[y][x] = Tile(char, None, 30)
                 pond.append((y, x))
-                empty.remove((y, x))
+
+    # Filter the claimed cells out in one pass instead of a list.remove() per cell
+    pond_cells = set(pond)
+    empty[:] = [coordinate for coordinate in empty if coordinate not in pond_cells]
     return pond
 
 
@@ -87,12 +98,11 @@ def paint_koi(matrix: CharacterMatrix, pond: Coordinates) -> None:
     ~<><~  or ~><>~
     ~~~~~     ~~~~~
     """
+    pond_cells = frozenset(pond)
     for y, x in random.sample(pond, len(pond)):
-        height = range(-1, 2)
-        width = range(-1, 4)
-        for y_offset, x_offset in itertools.product(height, width):
+        for y_offset, x_offset in KOI_NEIGHBORHOOD:
             # The fish must be surrounded by "~" on all sides
-            if (y + y_offset, x + x_offset) not in pond:
+            if (y + y_offset, x + x_offset) not in pond_cells:
                 break
         else:
             # Use today's "blessed" color for the koi fish
@@ -104,16 +114,25 @@ def paint_koi(matrix: CharacterMatrix, pond: Coordinates) -> None:
             break
 
 
-def render(matrix: CharacterMatrix, ansi_enabled: bool = True) -> str:
-    lines = []
+def render(matrix: CharacterMatrix) -> tuple[str, str]:
+    """
+    Render the garden in a single pass, returning the (ansi, plain) text.
+    """
+    # Build flat lists of fragments so that each version is joined only once
+    ansi_parts: list[str] = []
+    plain_parts: list[str] = []
     for row in ArtFile.merge_tiles(matrix):
-        if ansi_enabled:
-            line = [colorize(tile.char, tile.fg, tile.bg) for tile in row]
-        else:
-            line = [tile.char for tile in row]
-
-        lines.append("".join(line))
-    return "\n".join(lines)
+        if plain_parts:
+            ansi_parts.append("\n")
+            plain_parts.append("\n")
+        for tile in row:
+            if tile.fg is None and tile.bg is None:
+                # Blank ground dominates the garden, skip the colorize() call
+                ansi_parts.append(tile.char)
+            else:
+                ansi_parts.append(colorize(tile.char, tile.fg, tile.bg))
+            plain_parts.append(tile.char)
+    return "".join(ansi_parts), "".join(plain_parts)
 
 
 def build_matrix(update_users: bool) -> CharacterMatrix:
@@ -130,7 +149,8 @@ def build_matrix(update_users: bool) -> CharacterMatrix:
 
 def rebuild_garden(update_users: bool = True) -> dict:
     matrix = build_matrix(update_users)
-    data = {"ansi": render(matrix, ansi_enabled=True), "plain": render(matrix, ansi_enabled=False)}
+    ansi, plain = render(matrix)
+    data = {"ansi": ansi, "plain": plain}
     Config.write(Config.GARDEN_ART, data)
     return data
 
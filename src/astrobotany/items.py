@@ -587,3 +587,10 @@ badge_297 = Badge("tulip", series=3, number=97, symbol="🌷")
 badge_298 = Badge("herb", series=3, number=98, symbol="🌿")
 badge_299 = Badge("shamrock", series=3, number=99, symbol="☘️")
 badge_300 = Badge("partying face", series=3, number=100, symbol="🥳")
+
+# Item names only exist here and not in the database, so inventories can't be
+# sorted with ORDER BY. Rank every item by name once instead.
+NAME_ORDER: dict[int, int] = {
+    item.item_id: rank
+    for rank, item in enumerate(sorted(Item.registry.values(), key=lambda item: item.name))
+}
@@ -1,6 +1,8 @@
 import csv
 import io
+import time
 from collections.abc import Iterable
+from typing import Any
 
 from astrobotany.models import Plant, User
 from astrobotany.utils import ordinal_format
@@ -9,13 +11,24 @@ from astrobotany.utils import ordinal_format
 class Leaderboard:
     key: str = ""
     name: str = ""
+    cache_seconds: int = 60 * 10
 
     def __init__(self, count: int = 10) -> None:
         self.count = count
+        self._cache: dict[str, Any] = {}
 
     def list_top_items(self) -> Iterable:
         raise NotImplementedError
 
+    def get_top_items(self) -> list:
+        """
+        Return the top items, re-queried at most once every few minutes.
+        """
+        time_key = int(time.time() // self.cache_seconds)
+        if self._cache.get("time") != time_key:
+            self._cache = {"time": time_key, "items": list(self.list_top_items())}
+        return self._cache["items"]
+
     def render_table(self, width: int = 50) -> str:
         title = f"Leaderboard - {self.name}"
         table = [
@@ -24,7 +37,7 @@ class Leaderboard:
             "╠" + "═" * 25 + "╤" + "═" * (width - 28) + "╣",
         ]
 
-        items = list(self.list_top_items())
+        items = list(self.get_top_items())
         while len(items) < self.count:
             items.append(["", ""])
 
@@ -40,7 +53,7 @@ class Leaderboard:
         buffer = io.StringIO()
         writer = csv.writer(buffer)
         writer.writerow(["rank", "username", "value"])
-        for i, (username, value) in enumerate(self.list_top_items(), start=1):
+        for i, (username, value) in enumerate(self.get_top_items(), start=1):
             writer.writerow([str(i), username, value])
         return buffer.getvalue()
 
@@ -1,11 +1,21 @@
 import argparse
 from datetime import datetime, timedelta
 
-from peewee import BlobField, BooleanField, DateTimeField, IntegerField, TextField
+from peewee import (
+    BlobField,
+    BooleanField,
+    Case,
+    DateTimeField,
+    IntegerField,
+    TextField,
+    Value,
+    chunked,
+    fn,
+)
 from playhouse import migrate
 
 from astrobotany import items, settings
-from astrobotany.models import Certificate, ItemSlot, Plant, User, gen_user_id, init_db
+from astrobotany.models import Certificate, Inbox, ItemSlot, Plant, User, gen_user_id, init_db
 
 
 def add_setting_ansi_enabled(migrator):
@@ -20,22 +30,23 @@ def alter_user_id_type(migrator):
     )
 
 
+def _add_item_to_all_users(item: items.Item, quantity: int) -> None:
+    """
+    Give the item to every user that doesn't have it yet, in a single statement.
+    """
+    owned = ItemSlot.select().where(ItemSlot.user == User.id, ItemSlot.item_id == item.item_id)
+    query = User.select(User.id, Value(item.item_id), Value(quantity))
+    query = query.where(~fn.EXISTS(owned))
+    fields = [ItemSlot.user, ItemSlot.item_id, ItemSlot.quantity]
+    ItemSlot.insert_from(query, fields).execute()
+
+
 def add_item_paperclip(migrator):
-    for user in User.select():
-        ItemSlot.get_or_create(
-            user=user,
-            item_id=items.paperclip.item_id,
-            defaults={"quantity": 1},
-        )
+    _add_item_to_all_users(items.paperclip, quantity=1)
 
 
 def add_item_fertilizer(migrator):
-    for user in User.select():
-        ItemSlot.get_or_create(
-            user=user,
-            item_id=items.fertilizer.item_id,
-            defaults={"quantity": 5},
-        )
+    _add_item_to_all_users(items.fertilizer, quantity=5)
 
 
 def add_plant_fertilized_at(migrator):
@@ -52,6 +63,11 @@ def add_user_password_field(migrator):
 
 
 def migrate_certificates(migrator):
+    with User._meta.database.atomic():
+        _migrate_certificates()
+
+
+def _migrate_certificates():
     users = list(User.select())
 
     active_users = {}
@@ -61,19 +77,29 @@ def migrate_certificates(migrator):
         if user.plant.watered_at > watered_at:
             active_users[user.username] = user
 
+    certificates, new_user_ids, stale_ids = [], {}, []
     for user in users:
         active_user = active_users[user.username]
-        Certificate.create(
-            user=active_user,
-            authorised=not user.user_id.endswith("="),
-            fingerprint=user.user_id,
-            cn=user.username,
+        certificates.append(
+            Certificate(
+                user=active_user,
+                authorised=not user.user_id.endswith("="),
+                fingerprint=user.user_id,
+            )
         )
         if user == active_user:
-            user.user_id = gen_user_id()
-            user.save()
+            new_user_ids[user.id] = gen_user_id()
         else:
-            user.delete_instance()
+            stale_ids.append(user.id)
+
+    Certificate.bulk_create(certificates, batch_size=100)
+
+    for batch in chunked(new_user_ids.items(), 100):
+        user_id = Case(User.id, batch)
+        User.update(user_id=user_id).where(User.id.in_([pk for pk, _ in batch])).execute()
+
+    for batch in chunked(stale_ids, 100):
+        User.delete().where(User.id.in_(batch)).execute()
 
 
 def move_ansi_enabled(migrator):
@@ -81,10 +107,8 @@ def move_ansi_enabled(migrator):
         migrator.add_column("certificate", "ansi_enabled", BooleanField(default=False)),
     )
 
-    for user in User.select():
-        for cert in user.certificates:
-            cert.ansi_enabled = user.ansi_enabled
-            cert.save()
+    user_ansi_enabled = User.select(User.ansi_enabled).where(User.id == Certificate.user)
+    Certificate.update(ansi_enabled=user_ansi_enabled).execute()
 
 
 def add_shaken_at(migrator):
@@ -92,9 +116,7 @@ def add_shaken_at(migrator):
         migrator.add_column("plant", "shaken_at", IntegerField(default=False)),
     )
 
-    for plant in Plant.select():
-        plant.shaken_at = plant.score
-        plant.save()
+    Plant.update(shaken_at=Plant.score).execute()
 
 
 def add_inbox_item(migrator):
@@ -151,6 +173,18 @@ def add_fence_active(migrator):
     )
 
 
+def add_unread_count(migrator):
+    migrate.migrate(
+        migrator.add_column("user", "unread_count", IntegerField(default=0)),
+    )
+
+    unread_count = Inbox.select(fn.COUNT(Inbox.id)).where(
+        Inbox.user_to == User.id,
+        Inbox.is_seen == False,
+    )
+    User.update(unread_count=unread_count).execute()
+
+
 migrations = locals()
 
 
@@ -4,6 +4,7 @@ import json
 import math
 import os
 import random
+import time
 import uuid
 from collections.abc import Iterable
 from datetime import date, datetime, timedelta
@@ -42,10 +43,11 @@ def init_db(filename: str = ":memory:") -> SqliteDatabase:
         pragmas={
             "journal_mode": "wal",
             "synchronous": "normal",
-            "nmap_size": 134217728,
+            "mmap_size": 134217728,
             "journal_size_limit": 27103364,
             "cache_size": 10000000,
             "busy_timeout": 5000,
+            "temp_store": "memory",
         },
     )
     db.bind(BaseModel.model_registry)
@@ -104,10 +106,17 @@ class User(BaseModel):
     karma = IntegerField(default=0)
     garden_coordinates = TextField(null=True, default=None)
     fence_active = BooleanField(default=False)
+    unread_count = IntegerField(default=0)
+
+    class Meta:
+        # Avoid clobbering counters that are incremented in-place by other requests
+        only_save_dirty = True
 
     @classmethod
     def admin(cls) -> User:
-        user, _ = cls.get_or_create(user_id="0" * 32, username="admin")
+        user = cls.get_or_none(cls.user_id == "0" * 32)
+        if user is None:
+            user = cls.create(user_id="0" * 32, username="admin")
         return user
 
     @classmethod
@@ -138,29 +147,57 @@ class User(BaseModel):
         almost always access the user's plant later.
         """
         query = (
-            Certificate.select()
-            .join(User, on=Certificate.user == User.id)
-            .join(Plant, JOIN.LEFT_OUTER, on=Plant.user_active == User.id)
+            Certificate.select(Certificate, User, Plant)
+            .join(User)
+            .join(Plant, JOIN.LEFT_OUTER, on=(Plant.user_active == User.id), attr="_plant")
             .where(Certificate.fingerprint == fingerprint)
         )
 
         try:
             cert = query.get()
-            cert.last_seen = datetime.now()
-            cert.save()
         except Certificate.DoesNotExist:
-            cert = None
+            return None
+
+        # Skip the write unless the timestamp is noticeably out of date, so
+        # that most requests don't need to touch the database a second time
+        now = datetime.now()
+        if now - cert.last_seen >= Certificate.LAST_SEEN_RESOLUTION:
+            cert.last_seen = now
+            cert.save(only=[Certificate.last_seen])
 
         return cert
 
+    @classmethod
+    def select_with_plant(cls):
+        """
+        Select users joined on their active plant, so that user.plant doesn't
+        need to make an extra query for each row.
+        """
+        return cls.select(cls, Plant).join(
+            Plant, JOIN.LEFT_OUTER, on=(Plant.user_active == cls.id), attr="_plant"
+        )
+
+    @classmethod
+    def get_with_plant(cls, user_id: str) -> User | None:
+        """
+        Look up a user by their public ID, joined on their active plant.
+        """
+        query = cls.select_with_plant().where(cls.user_id == user_id)
+
+        try:
+            return query.get()
+        except User.DoesNotExist:
+            return None
+
     @property
     def plant(self) -> Plant:
         """
         Return the user's current "active" plant, or generate a new one.
 
-        This is cached locally to avoid unnecessary DB lookups.
+        This is cached locally to avoid unnecessary DB lookups. A LEFT OUTER
+        JOIN with no matching plant caches None, which is treated as a miss.
         """
-        if not hasattr(self, "_plant"):
+        if getattr(self, "_plant", None) is None:
             try:
                 self._plant = self.active_plants.get()
             except Plant.DoesNotExist:
@@ -196,6 +233,13 @@ class User(BaseModel):
         self.password = bcrypt.hashpw(password.encode(), bcrypt.gensalt())
 
     def check_password(self, password: str) -> bool:
+        """
+        Verify the password against the stored bcrypt hash.
+
+        This is slow on purpose and blocks the reactor thread while it runs, so
+        callers must check password_failed_rate_limiter first to bound how
+        often a single client can trigger it.
+        """
         if not self.password:
             return False
         return bcrypt.checkpw(password.encode(), self.password)
@@ -204,7 +248,10 @@ class User(BaseModel):
         """
         Add an item to the user's inventory.
         """
-        item_slot, _ = ItemSlot.get_or_create(user=self, item_id=item.item_id)
+        item_slot = ItemSlot.get_or_none(user=self, item_id=item.item_id)
+        if item_slot is None:
+            return ItemSlot.create(user=self, item_id=item.item_id, quantity=quantity)
+
         item_slot.quantity += quantity
         item_slot.save()
         return item_slot
@@ -240,6 +287,15 @@ class User(BaseModel):
 
         return 0
 
+    def get_item_quantities(self) -> dict[int, int]:
+        """
+        Return the quantity of every item in the user's inventory, keyed by item ID.
+
+        This loads the whole inventory in a single query, use it instead of
+        calling get_item_quantity() in a loop.
+        """
+        return {item_slot.item_id: item_slot.quantity for item_slot in self.inventory}
+
     @property
     def christmas_mode(self) -> bool:
         """
@@ -280,6 +336,8 @@ class Certificate(BaseModel):
     A client certificate used for user authentication.
     """
 
+    LAST_SEEN_RESOLUTION = timedelta(minutes=5)
+
     user = ForeignKeyField(User, backref="certificates")
     authorised = BooleanField(default=False)
     fingerprint = TextField(unique=True, index=True)
@@ -327,9 +385,40 @@ class Message(BaseModel):
     created_at = DateTimeField(default=datetime.now)
     text = TextField()
 
+    _count_cache: dict[str, int] = {}
+    _count_cache_seconds: int = 60
+
+    @classmethod
+    def by_date(cls, before_id: int | None = None):
+        """
+        Return messages from newest to oldest.
+
+        Pass the ID of the last message on the previous page to paginate by
+        keyset instead of by OFFSET, which must scan all of the skipped rows.
+        The authors are selected in the same query since they're always shown.
+        """
+        # Unary minus is peewee's shorthand for DESC, cls.id is typed as an int
+        query = cls.select(cls, User).join(User).order_by(-cls.id)
+        if before_id is not None:
+            query = query.where(cls.id < before_id)
+        return query
+
     @classmethod
-    def by_date(cls):
-        return cls.select().order_by(cls.created_at.desc())
+    def get_count(cls) -> int:
+        """
+        Return the total number of messages, recounted at most once a minute.
+        """
+        time_key = int(time.time() // cls._count_cache_seconds)
+        if cls._count_cache.get("time") != time_key:
+            cls._count_cache = {"time": time_key, "count": cls.select().count()}
+        return cls._count_cache["count"]
+
+    @classmethod
+    def reset_count(cls) -> None:
+        """
+        Force the next call to get_count() to recount the messages.
+        """
+        cls._count_cache = {}
 
     def can_delete(self):
         return self.created_at > datetime.now() - timedelta(days=1)
@@ -344,22 +433,31 @@ class ItemSlot(BaseModel):
     item_id = IntegerField()
     quantity = IntegerField(default=0)
 
+    _item: items.Item
+
     @property
     def item(self) -> items.Item:
-        item = items.Item.lookup(self.item_id)  # noqa
-        if item is None:
-            raise ValueError("Invalid item ID")
+        """
+        Resolve the item from the registry.
+
+        This is cached locally because templates access it several times per slot.
+        """
+        if not hasattr(self, "_item"):
+            item = items.Item.lookup(self.item_id)  # noqa
+            if item is None:
+                raise ValueError("Invalid item ID")
+            self._item = item
 
-        return item
+        return self._item
 
     @classmethod
-    def store_view(cls, user: User) -> Iterable[ItemSlot]:
-        item_slots = {item_slot.item_id: item_slot for item_slot in user.inventory}
+    def store_view(cls, user: User, quantities: dict[int, int] | None = None) -> Iterable[ItemSlot]:
+        if quantities is None:
+            quantities = user.get_item_quantities()
+
         for item in items.get_store_items(user):
-            try:
-                yield item_slots[item.item_id]
-            except KeyError:
-                yield ItemSlot(user=user, item_id=item.item_id)
+            quantity = quantities.get(item.item_id, 0)
+            yield ItemSlot(user=user, item_id=item.item_id, quantity=quantity)
 
 
 class Event(BaseModel):
@@ -394,6 +492,41 @@ class Inbox(BaseModel):
     parent = ForeignKeyField("self", null=True, backref="children")
     item_id = IntegerField(null=True, default=None)
 
+    # Raw foreign key values, dynamically attached by Peewee
+    user_from_id: int
+    user_to_id: int
+
+    def save(self, *args, **kwargs):
+        """
+        Keep the recipient's denormalized unread_count in sync with new messages.
+        """
+        created = self._pk is None or kwargs.get("force_insert", False)
+        rows = super().save(*args, **kwargs)
+        if created and not self.is_seen:
+            query = User.update(unread_count=User.unread_count + 1)
+            query.where(User.id == self.user_to_id).execute()
+        return rows
+
+    def mark_seen(self) -> bool:
+        """
+        Flag the message as read by the recipient.
+
+        Returns True only when this call flipped the flag, which makes it
+        idempotent: opening the same postcard again won't deliver its attached
+        item or decrement unread_count a second time.
+        """
+        if self.is_seen:
+            return False
+
+        self.is_seen = True
+        query = Inbox.update(is_seen=True).where(Inbox.id == self.id, Inbox.is_seen == False)
+        if not query.execute():
+            return False
+
+        query = User.update(unread_count=User.unread_count - 1)
+        query.where(User.id == self.user_to_id, User.unread_count > 0).execute()
+        return True
+
     @property
     def date_str(self) -> str:
         return self.created_at.strftime("%Y-%m-%d")  # noqa
@@ -402,12 +535,17 @@ class Inbox(BaseModel):
     def datetime_str(self) -> str:
         return self.created_at.strftime("%A, %B %d, %Y %-I:%M:%S %p (EST)")  # noqa
 
+    _item: items.Item | None
+
     @property
     def item(self) -> items.Item | None:
-        if self.item_id is not None:
-            return items.Item.lookup(self.item_id)  # noqa
-        else:
-            return None
+        if not hasattr(self, "_item"):
+            if self.item_id is not None:
+                self._item = items.Item.lookup(self.item_id)  # noqa
+            else:
+                self._item = None
+
+        return self._item
 
     @classmethod
     def load_mail_file(cls, filename: str) -> tuple[str, str]:
@@ -476,9 +614,20 @@ class Plant(BaseModel):
     fertilized_at = DateTimeField(default=lambda: datetime.now() - timedelta(days=4))
     shaken_at = IntegerField(default=0)
 
+    class Meta:
+        # Only write the columns that changed, so that refreshing a plant
+        # doesn't overwrite a neighbor watering it at the same time
+        only_save_dirty = True
+
     @classmethod
     def all_active(cls):
-        return cls.filter(cls.user_active.is_null(False)).join(User)
+        """
+        Select all active plants along with their owners.
+
+        The user columns are selected in the same query because nearly every
+        listing displays the owner's name next to the plant.
+        """
+        return cls.select(cls, User).join(User).where(cls.user_active.is_null(False))
 
     @classmethod
     def all_alive(cls):
@@ -761,20 +910,25 @@ class Plant(BaseModel):
 
         return "\n".join(observation)
 
-    def refresh(self) -> None:
+    def refresh(self) -> bool:
         """
         Update the internal state of the plant.
 
         This will recompute the plant's score, remaining water supply,
         mutations, any evolutions that should be happening, etc...
+
+        Returns False if nothing but the update timestamp changed. In that case
+        the plant doesn't need to be saved, because refreshing again from the
+        old timestamp will compute the same result.
         """
         last_updated = self.updated_at
         self.updated_at = datetime.now()
 
         # If it has been >5 days since watering, sorry plant is dead :(
         if self.updated_at - self.watered_at >= timedelta(days=5):
+            was_dead = self.dead
             self.dead = True
-            return
+            return not was_dead
 
         # Add a tick for every second since we last updated, up to 24 hours
         # after the last time the plant was watered
@@ -797,6 +951,9 @@ class Plant(BaseModel):
 
         ticks *= self.growth_rate
         ticks = int(ticks)
+        if not ticks:
+            return False
+
         self.score += ticks
 
         # Roll for a new mutation
@@ -812,6 +969,8 @@ class Plant(BaseModel):
             else:
                 break
 
+        return True
+
     def water(self, user: User | None = None) -> str:
         """
         Attempt to water the plant.
@@ -983,3 +1142,16 @@ class Plant(BaseModel):
             user_active=self.user,
             generation=new_generation,
         )
+
+
+# Covers the garden and API listings, which filter on both columns and sort by
+# score. Only active plants are indexed because harvested plants are kept around
+# forever and would otherwise make up most of the index.
+Plant.add_index(
+    Plant.index(
+        Plant.score.desc(),
+        Plant.watered_at,
+        name="plant_active_score_watered_at",
+        where=Plant.user_active.is_null(False),
+    )
+)
@@ -1,4 +1,6 @@
 class PostcardData:
+    __slots__ = ("user", "subject", "item", "lines")
+
     def __init__(self):
         self.user = None
         self.subject = None
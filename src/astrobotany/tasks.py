@@ -9,9 +9,11 @@ This script is intended to be invoked from a cron file like this...
 
 import argparse
 
+from peewee import fn
+
 from astrobotany import settings
 from astrobotany.garden import rebuild_garden
-from astrobotany.models import Plant, init_db
+from astrobotany.models import Inbox, Plant, User, init_db
 
 
 class Schedule:
@@ -37,8 +39,8 @@ def refresh_all_plants():
     Refresh plants every hour to keep the garden page up to date.
     """
     for plant in Plant.all_active():
-        plant.refresh()
-        plant.save()
+        if plant.refresh():
+            plant.save()
 
 
 @schedule.hourly
@@ -51,6 +53,24 @@ def refresh_garden_art():
     rebuild_garden(update_users=True)
 
 
+@schedule.daily
+def sync_unread_counts():
+    """
+    Recount unread mail for every user, in case the denormalized counter on
+    the user table has drifted from the inbox table.
+    """
+    unread_counts = dict(
+        Inbox.select(Inbox.user_to, fn.COUNT(Inbox.id))
+        .where(Inbox.is_seen == False)
+        .group_by(Inbox.user_to)
+        .tuples()
+    )
+    for user in User.select(User.id, User.unread_count):
+        count = unread_counts.get(user.id, 0)
+        if user.unread_count != count:
+            User.update(unread_count=count).where(User.id == user.id).execute()
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("type", choices=["hourly", "daily"])
@@ -1,17 +1,19 @@
+import functools
 import json
-import math
 import mimetypes
 import os
 import pathlib
+import re
+import time
+from collections.abc import Iterator
 from datetime import datetime, timedelta
 
 from jetforce import Response, Status
-from jetforce.app.base import RateLimiter
-from peewee import fn
+from peewee import IntegrityError, fn
 
 from astrobotany import items
-from astrobotany.app import STATIC_DIR, app, render_template
-from astrobotany.art import render_art
+from astrobotany.app import STATIC_DIR, RateLimiter, app, render_template
+from astrobotany.art import prerender_art, render_art
 from astrobotany.garden import load_garden
 from astrobotany.leaderboard import leaderboards
 from astrobotany.models import Certificate, Inbox, ItemSlot, Message, Plant, User
@@ -19,39 +21,90 @@ from astrobotany.pond import Pond
 from astrobotany.postcards import PostcardData
 from astrobotany.sounds import Synthesizer
 
+# Menu artwork is the same for every user, so render it at startup instead of
+# making the first visitor to each page wait on parsing the art file
+prerender_art(
+    "title.psci",
+    "mailbox.psci",
+    "duck.psci",
+    "epilog1.psci",
+    "epilog2.psci",
+    "epilog3.psci",
+    "epilog4.psci",
+)
+
 password_failed_rate_limiter = RateLimiter("10/5m")
 new_account_rate_limiter = RateLimiter("2/4h")
 message_rate_limiter = RateLimiter("3/h")
 
+# Resubmitting the same message this soon is treated as an accidental double-post
+DUPLICATE_MESSAGE_SECONDS = 5
+
+# Printable US-ASCII, up to 30 characters
+USERNAME_RE = re.compile(r"[\x20-\x7E]{1,30}")
+
+# Accepted replies to yes/no and true/false prompts, after lowercasing
+YES_ANSWERS = frozenset(("y", "yes"))
+TRUE_ANSWERS = frozenset(("t", "true"))
+FALSE_ANSWERS = frozenset(("f", "false"))
+EMOJI_MODE_ANSWERS = frozenset(("0", "1", "2"))
+
+# Static files larger than this are streamed from disk instead of held in memory
+STATIC_CACHE_MAX_SIZE = 16 * 1024
+STATIC_CHUNK_SIZE = 64 * 1024
+
+# Public pages are linked from outside of the capsule and get refreshed by
+# crawlers, so the rendered pages are kept for a short time
+PUBLIC_CACHE_SECONDS = 60
+PUBLIC_CACHE_MAX_SIZE = 2048
+_public_cache: dict[tuple[str, str], tuple[float, str]] = {}
+
+# Stand-in certificates for rendering public pages, keyed by the URL's mode
+PUBLIC_CERTS = {
+    "0": Certificate(ansi_enabled=False),
+    "1": Certificate(ansi_enabled=True),
+}
+
 
 @app.route("")
 def index_view(request):
-    title_art = render_art("title.psci")
+    title_art = render_art("title.psci", ansi_enabled=False)
+
+    # Timestamps are stored as naive local times, so compare against local "now"
+    minutes_ago = (fn.strftime("%s", "now", "localtime") - fn.strftime("%s", Plant.watered_at)) / 60
 
     query = (
         Plant.all_active()
+        .select_extend(minutes_ago.alias("minutes_ago"))
         .where(Plant.watered_by.is_null(True))
         .order_by(Plant.watered_at.desc())
         .limit(5)
     )
 
-    activity = []
-    for plant in query:
-        dt = datetime.now() - plant.watered_at
-        activity.append((plant.user.username, dt))
+    activity = [(plant.user.username, plant.minutes_ago) for plant in query]
 
     total = User.select().count()
     body = render_template("index.gmi", title_art=title_art, activity=activity, total=total)
     return Response(Status.SUCCESS, "text/gemini", body)
 
 
-@app.route("/news")
-def news_view(request):
+@functools.lru_cache(1)
+def list_news_files(mtime: float) -> list[str]:
+    """
+    List the changelog pages, keyed on the directory mtime so deploys are picked up.
+    """
     files = []
     for filename in os.listdir(os.path.join(STATIC_DIR, "changes")):
         files.append(os.path.splitext(filename)[0])
 
     files.sort(reverse=True)
+    return files
+
+
+@app.route("/news")
+def news_view(request):
+    mtime = os.stat(os.path.join(STATIC_DIR, "changes")).st_mtime
+    files = list_news_files(mtime)
 
     body = render_template("news.gmi", files=files)
     return Response(Status.SUCCESS, "text/gemini", body)
@@ -73,12 +126,11 @@ def register_new_view(request):
         msg = "Enter your desired username (US-ASCII characters only)"
         return Response(Status.INPUT, msg)
 
-    if not username.isascii():
-        msg = f"The username '{username}' contains invalid characters, try again"
-        return Response(Status.INPUT, msg)
-
-    if len(username) > 30:
-        msg = f"The username '{username}' is too long, try again"
+    if not USERNAME_RE.fullmatch(username):
+        if len(username) > 30:
+            msg = f"The username '{username}' is too long, try again"
+        else:
+            msg = f"The username '{username}' contains invalid characters, try again"
         return Response(Status.INPUT, msg)
 
     if User.select().where(User.username == username).exists():
@@ -91,14 +143,21 @@ def register_new_view(request):
 
     cert = request.environ["client_certificate"]
 
-    user = User.initialize(username)
-    Certificate.create(
-        user=user,
-        fingerprint=fingerprint,
-        subject=cert.subject.rfc4514_string(),
-        not_valid_before_utc=cert.not_valid_before,
-        not_valid_after_utc=cert.not_valid_after,
-    )
+    try:
+        # Commit the user, starting items, welcome mail, and certificate together
+        with User._meta.database.atomic():
+            user = User.initialize(username)
+            Certificate.create(
+                user=user,
+                fingerprint=fingerprint,
+                subject=cert.subject.rfc4514_string(),
+                not_valid_before_utc=cert.not_valid_before,
+                not_valid_after_utc=cert.not_valid_after,
+            )
+    except IntegrityError:
+        # The same certificate was registered by a concurrent request
+        msg = "This certificate has already been linked to an account."
+        return Response(Status.CERTIFICATE_NOT_AUTHORISED, msg)
 
     return Response(Status.REDIRECT_TEMPORARY, "/app")
 
@@ -159,18 +218,43 @@ def register_existing_view(request, user_id=None):
     return Response(Status.REDIRECT_TEMPORARY, "/app")
 
 
-@app.route("/static/(?P<path>.*)")
-def static_view(request, path):
+@functools.lru_cache(256)
+def read_static_file(filepath: pathlib.Path) -> bytes:
+    """
+    Load a small static file into memory.
+    """
+    return filepath.read_bytes()
+
+
+def stream_static_file(filepath: pathlib.Path) -> Iterator[bytes]:
+    """
+    Yield a static file from disk in fixed-size chunks.
+    """
+    with filepath.open("rb") as fp:
+        while chunk := fp.read(STATIC_CHUNK_SIZE):
+            yield chunk
+
+
+@functools.lru_cache(512)
+def resolve_static_file(path: str) -> tuple[pathlib.Path | None, str, int]:
+    """
+    Map a URL path to a file in the static directory along with its mimetype
+    and size.
+
+    Returns None for the filepath if the URL does not point to a valid file.
+    Static files ship with the package and only change on deploy, so the
+    result is safe to cache for the lifetime of the process.
+    """
     url_path = pathlib.Path(path.strip("/"))
 
     filename = pathlib.Path(os.path.normpath(str(url_path)))
     if filename.is_absolute() or str(filename).startswith(".."):
         # Guard against breaking out of the directory
-        return Response(Status.NOT_FOUND, "Not Found")
+        return None, "", 0
 
     filepath = STATIC_DIR / filename
-    if not filepath.exists():
-        return Response(Status.NOT_FOUND, "Not Found")
+    if not filepath.is_file():
+        return None, "", 0
 
     mime, encoding = mimetypes.guess_type(str(filename))
     if encoding:
@@ -178,14 +262,26 @@ def static_view(request, path):
     else:
         mimetype = mime or "application/octet-stream"
 
-    body = filepath.read_bytes()
+    return filepath, mimetype, filepath.stat().st_size
+
+
+@app.route("/static/(?P<path>.*)")
+def static_view(request, path):
+    filepath, mimetype, size = resolve_static_file(path)
+    if filepath is None:
+        return Response(Status.NOT_FOUND, "Not Found")
+
+    if size <= STATIC_CACHE_MAX_SIZE:
+        body = read_static_file(filepath)
+    else:
+        body = stream_static_file(filepath)
     return Response(Status.SUCCESS, mimetype, body)
 
 
 @app.auth_route("/app")
 def app_view(request):
     title_art = render_art("title.psci", ansi_enabled=request.cert.ansi_enabled)
-    mailbox_count = request.user.inbox.where(Inbox.is_seen == False).count()
+    mailbox_count = request.user.unread_count
     now = datetime.now()
     body = request.render_template(
         "menu.gmi", title_art=title_art, mailbox_count=mailbox_count, now=now
@@ -207,21 +303,28 @@ def epilog_view(request, page):
 
 @app.auth_route("/app/message-board")
 @app.auth_route("/app/message-board/(?P<page>[0-9]+)")
-def message_board_view(request, page=1):
+@app.auth_route("/app/message-board/(?P<page>[0-9]+)/(?P<cursor>[0-9]+)")
+def message_board_view(request, page=1, cursor=None):
     page = int(page)
     paginate_by = 20
-    page_count = int(math.ceil(Message.select().count() / paginate_by))
-    page_count = max(page_count, 1)
+    page_count = max(-(-Message.get_count() // paginate_by), 1)
     if page > page_count:
         return Response(Status.NOT_FOUND, "Invalid page number")
 
-    messages = Message.by_date().paginate(page, paginate_by)
+    if cursor is not None:
+        messages = list(Message.by_date(before_id=int(cursor)).limit(paginate_by))
+    else:
+        # Fallback for numbered page links without a cursor
+        messages = list(Message.by_date().paginate(page, paginate_by))
+
+    next_cursor = messages[-1].id if messages else None
 
     body = request.render_template(
         "message_board.gmi",
         items=messages,
         page=page,
         page_count=page_count,
+        next_cursor=next_cursor,
     )
     return Response(Status.SUCCESS, "text/gemini", body)
 
@@ -235,13 +338,17 @@ def message_board_submit_view(request):
     if rate_limit_resp:
         return rate_limit_resp
 
-    last = Message.select().order_by(Message.id.desc()).first()  # noqa
-    if last and (last.user, last.text) == (request.user, request.query):
+    text_hash = hash(request.query)
+    now = time.monotonic()
+    last_hash, last_time = request.session.get("last_message", (None, 0.0))
+    if last_hash == text_hash and now - last_time < DUPLICATE_MESSAGE_SECONDS:
         # Almost definitely an accidental double-post by the user
         return Response(Status.REDIRECT_TEMPORARY, "/app/message-board")
 
     message = Message(user=request.user, text=request.query)
     message.save()
+    Message.reset_count()
+    request.session["last_message"] = (text_hash, now)
     return Response(Status.REDIRECT_TEMPORARY, "/app/message-board")
 
 
@@ -267,6 +374,8 @@ def message_board_delete_view(request, message_id: str):
     confirm = request.query.lower().strip() == "y"
     if confirm:
         message.delete_instance()
+        Message.reset_count()
+        request.session.pop("last_message", None)
 
     return Response(Status.REDIRECT_TEMPORARY, "/app/message-board")
 
@@ -308,12 +417,12 @@ def settings_ansi_enabled_view(request):
 
     answer = request.query.strip().lower()
 
-    if answer in ("t", "true"):
+    if answer in TRUE_ANSWERS:
         request.cert.ansi_enabled = True
-        request.cert.save()
-    elif answer in ("f", "false"):
+        request.cert.save(only=[Certificate.ansi_enabled])
+    elif answer in FALSE_ANSWERS:
         request.cert.ansi_enabled = False
-        request.cert.save()
+        request.cert.save(only=[Certificate.ansi_enabled])
     else:
         return Response(Status.BAD_REQUEST, f"Invalid query value: {request.query}")
 
@@ -328,9 +437,9 @@ def settings_emoji_mode_view(request):
 
     answer = request.query.strip()
 
-    if answer in ("0", "1", "2"):
+    if answer in EMOJI_MODE_ANSWERS:
         request.cert.emoji_mode = int(answer)
-        request.cert.save()
+        request.cert.save(only=[Certificate.emoji_mode])
     else:
         return Response(Status.BAD_REQUEST, f"Invalid query value: {request.query}")
 
@@ -416,8 +525,9 @@ def settings_certificates_delete_view(request, certificate_id):
 
 @app.auth_route("/app/store")
 def store_view(request):
-    for_sale = ItemSlot.store_view(request.user)
-    coins = request.user.get_item_quantity(items.coin)
+    quantities = request.user.get_item_quantities()
+    for_sale = ItemSlot.store_view(request.user, quantities)
+    coins = quantities.get(items.coin.item_id, 0)
     body = request.render_template("store.gmi", for_sale=for_sale, coins=coins)
     return Response(Status.SUCCESS, "text/gemini", body)
 
@@ -458,7 +568,7 @@ def store_purchase_view(request, item_id, amount):
         msg = f"Confirm: purchase {amount} {item.name} for {price} coins. [Y]es/[N]o."
         return Response(Status.INPUT, msg)
 
-    if request.query.strip().lower() in ("y", "yes"):
+    if request.query.strip().lower() in YES_ANSWERS:
         if request.user.remove_item(items.coin, quantity=price):
             request.user.add_item(item, quantity=amount)
         else:
@@ -481,9 +591,11 @@ def mailbox_view(request):
 
 @app.auth_route("/app/mailbox/outgoing")
 def mailbox_outgoing_view(request):
+    quantities = request.user.get_item_quantities()
+
     postcards = []
     for postcard in items.Postcard.postcards:
-        quantity = request.user.get_item_quantity(postcard)
+        quantity = quantities.get(postcard.item_id, 0)
         if quantity:
             postcards.append((postcard, quantity))
 
@@ -601,7 +713,7 @@ def mailbox_send_view(request, postcard_id):
         msg = f"Confirm: send postcard to {data.user.username}. [Y]es/[N]o."
         return Response(Status.INPUT, msg)
 
-    if request.query.strip().lower() not in ("y", "yes"):
+    if request.query.strip().lower() not in YES_ANSWERS:
         return Response(Status.SUCCESS, "text/gemini", "Action cancelled.")
 
     if data.item:
@@ -634,13 +746,10 @@ def mailbox_message_view(request, message_id):
         return Response(Status.BAD_REQUEST, "You shouldn't be here!")
 
     new_item_slot = None
-    if message.user_to == request.user:
-        if not message.is_seen:
-            if message.item:
-                new_item_slot = request.user.add_item(message.item, quantity=1)
-            message.is_seen = True
-            message.save()
-    elif message.user_from == request.user:
+    if message.user_to_id == request.user.id:
+        if message.mark_seen() and message.item:
+            new_item_slot = request.user.add_item(message.item, quantity=1)
+    elif message.user_from_id == request.user.id:
         pass
     else:
         return Response(Status.BAD_REQUEST, "You shouldn't be here!")
@@ -708,9 +817,10 @@ def garden_view(request, filter="all", page=1):
 
     page = int(page)
     paginate_by = 20
-    total = query.count()
-    page_count = int(math.ceil(total / paginate_by))
-    page_count = max(page_count, 1)
+    # The counts for each filter were just computed above, search is the only
+    # query that hasn't been counted yet
+    total = plant_counts[filter] if filter in plant_counts else query.count()
+    page_count = max(-(-total // paginate_by), 1)
     if page > page_count:
         return Response(Status.NOT_FOUND, "Invalid page number")
 
@@ -732,8 +842,8 @@ def garden_view(request, filter="all", page=1):
 @app.auth_route("/app/plant")
 def plant_view(request):
     plant = request.user.plant
-    plant.refresh()
-    plant.save()
+    if plant.refresh():
+        plant.save()
 
     alert = request.session.pop("alert", None)
     if alert is None:
@@ -745,15 +855,15 @@ def plant_view(request):
 
 @app.auth_route("/app/visit/(?P<user_id>[0-9a-f]{32})")
 def visit_plant_view(request, user_id: str):
-    user = User.get_or_none(User.user_id == user_id)
+    user = User.get_with_plant(user_id)
     if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
     elif user == request.user:
         return Response(Status.REDIRECT_TEMPORARY, "/app/plant")
 
     plant = user.plant
-    plant.refresh()
-    plant.save()
+    if plant.refresh():
+        plant.save()
 
     alert = request.session.pop("alert", None)
 
@@ -777,7 +887,7 @@ def water_view(request):
 
 @app.auth_route("/app/visit/(?P<user_id>[0-9a-f]{32})/water")
 def visit_water_view(request, user_id: str):
-    user = User.get_or_none(User.user_id == user_id)
+    user = User.get_with_plant(user_id)
     if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
     elif user == request.user:
@@ -811,7 +921,7 @@ def fertilize_view(request):
 
 @app.auth_route("/app/visit/(?P<user_id>[0-9a-f]{32})/fertilize")
 def visit_fertilize_view(request, user_id: str):
-    user = User.get_or_none(User.user_id == user_id)
+    user = User.get_with_plant(user_id)
     if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
     elif user == request.user:
@@ -859,7 +969,7 @@ def search_view(request):
 
 @app.auth_route("/app/visit/(?P<user_id>[0-9a-f]{32})/search")
 def visit_search_view(request, user_id: str):
-    user = User.get_or_none(User.user_id == user_id)
+    user = User.get_with_plant(user_id)
     if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
     elif user == request.user:
@@ -894,7 +1004,7 @@ def song_view(request):
 
 @app.auth_route("/app/visit/(?P<user_id>[0-9a-f]{32})/song")
 def visit_song_view(request, user_id: str):
-    user = User.get_or_none(User.user_id == user_id)
+    user = User.get_with_plant(user_id)
     if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
     elif user == request.user:
@@ -997,7 +1107,7 @@ def plant_rename_view(request):
 
 @app.auth_route("/app/inventory")
 def inventory_view(request):
-    inventory = sorted(request.user.inventory, key=lambda x: x.item.name)
+    inventory = sorted(request.user.inventory, key=lambda x: items.NAME_ORDER[x.item_id])
     body = request.render_template("inventory.gmi", inventory=inventory)
     return Response(Status.SUCCESS, "text/gemini", body)
 
@@ -1023,20 +1133,25 @@ def inventory_view_item(request, item_slot_id):
 @app.route("/public/(?P<user_id>[0-9a-f]{32})")
 @app.route("/public/(?P<user_id>[0-9a-f]{32})/m(?P<mode>[0-9])+")
 def public_view(request, user_id: str, mode: str = "0"):
-    user = User.get_or_none(User.user_id == user_id)
-    if user is None:
+    now = time.monotonic()
+    cached = _public_cache.get((user_id, mode))
+    if cached is not None and now - cached[0] < PUBLIC_CACHE_SECONDS:
+        return Response(Status.SUCCESS, "text/gemini", cached[1])
+
+    cert = PUBLIC_CERTS.get(mode)
+    if cert is None:
         return Response(Status.NOT_FOUND, "Not Found")
 
-    if mode == "0":
-        ansi_enabled = False
-    elif mode == "1":
-        ansi_enabled = True
-    else:
+    user = User.get_with_plant(user_id)
+    if user is None:
         return Response(Status.NOT_FOUND, "Not Found")
 
-    request.cert = Certificate(ansi_enabled=ansi_enabled)
+    request.cert = cert
 
     body = render_template("public.gmi", request=request, plant=user.plant)
+    if len(_public_cache) >= PUBLIC_CACHE_MAX_SIZE:
+        _public_cache.clear()
+    _public_cache[(user_id, mode)] = (now, body)
     return Response(Status.SUCCESS, "text/gemini", body)
 
 
@@ -1,13 +1,17 @@
 import os
 import uuid
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 import pytest
+from jetforce import Status
+from playhouse.test_utils import count_queries
 
-from astrobotany import items, sounds, tasks
-from astrobotany.art import ArtFile
+from astrobotany import garden, items, sounds, tasks, views
+from astrobotany.app import EMOJI_FILTERS, AstrobotanyApplication, RateLimiter, load_session
+from astrobotany.art import ArtFile, colorize
 from astrobotany.constants import COLOR_MAP, COLORS, SPECIES, STAGES
-from astrobotany.models import Certificate, Plant, Song, User
+from astrobotany.models import Certificate, Inbox, Message, Plant, Song, User
 
 
 def gen_id():
@@ -203,6 +207,17 @@ def test_plant_refresh_dead(now):
     assert plant.score == 0
 
 
+def test_plant_refresh_unchanged(now):
+    watered_at = now - timedelta(days=2)
+    updated_at = now - timedelta(days=1)
+    plant = plant_factory(watered_at=watered_at, updated_at=updated_at)
+    assert plant.refresh() is False
+    assert plant.score == 0
+
+    plant = plant_factory(watered_at=now - timedelta(hours=12), updated_at=updated_at)
+    assert plant.refresh() is True
+
+
 def test_plant_refresh_12h(now):
     watered_at = now - timedelta(hours=12)
     updated_at = now - timedelta(hours=12)
@@ -356,6 +371,49 @@ def test_user_login():
     assert User.login(cert.fingerprint) == cert
 
 
+def test_user_login_preloads_plant():
+    user = user_factory()
+    plant = user.plant
+    cert = certificate_factory(user=user)
+
+    cert = User.login(cert.fingerprint)
+    with count_queries() as counter:
+        assert cert.user.plant == plant
+    assert counter.count == 0
+
+
+def test_user_login_without_plant():
+    user = user_factory()
+    cert = certificate_factory(user=user)
+
+    cert = User.login(cert.fingerprint)
+    plant = cert.user.plant
+    assert plant is not None
+    assert plant.user_active_id == user.id
+
+
+def test_user_get_with_plant():
+    user = user_factory()
+    plant = user.plant
+
+    assert User.get_with_plant("invalid_user_id") is None
+
+    loaded = User.get_with_plant(user.user_id)
+    with count_queries() as counter:
+        assert loaded.plant == plant
+    assert counter.count == 0
+
+
+def test_user_get_with_plant_without_plant():
+    user = user_factory()
+
+    loaded = User.get_with_plant(user.user_id)
+    assert loaded.plant.user_active_id == user.id
+
+    response = views.public_view(SimpleNamespace(), user.user_id)
+    assert response.status == Status.SUCCESS
+
+
 def test_user_password():
     user = user_factory()
     assert not user.check_password("foobar")
@@ -376,6 +434,15 @@ def test_user_initialize():
     assert user.inbox.count() == 1
 
 
+def test_user_get_item_quantities():
+    user = user_factory()
+    user.add_item(items.coin, quantity=5)
+    user.add_item(items.fertilizer)
+
+    quantities = user.get_item_quantities()
+    assert quantities == {items.coin.item_id: 5, items.fertilizer.item_id: 1}
+
+
 def test_shake_plant_empty():
     user = user_factory()
     assert user.get_item_quantity(items.coin) == 0
@@ -454,3 +521,165 @@ def test_login_saves_last_seen(frozen_time, now):
 
     cert = Certificate.get_by_id(cert.id)
     assert cert.last_seen == now + timedelta(hours=1)
+
+
+def test_message_by_date_before_id():
+    user = user_factory()
+    messages = [Message.create(user=user, text=str(i)) for i in range(5)]
+
+    query = Message.by_date(before_id=messages[3].id)
+    assert [message.text for message in query] == ["2", "1", "0"]
+
+
+def test_emoji_filters():
+    assert EMOJI_FILTERS[1]("🌱 sprout") == ":seedling: sprout"
+    assert EMOJI_FILTERS[2]("🌱 sprout") == " sprout"
+    assert 0 not in EMOJI_FILTERS
+
+
+def test_login_throttles_last_seen(frozen_time, now):
+    user = user_factory()
+    cert = certificate_factory(user=user, last_seen=now)
+
+    frozen_time.tick(delta=timedelta(seconds=10))
+    user.login(cert.fingerprint)
+
+    cert = Certificate.get_by_id(cert.id)
+    assert cert.last_seen == now
+
+
+def test_inbox_unread_count():
+    user = User.initialize(gen_id())
+    assert User.get_by_id(user.id).unread_count == 1
+
+    message = user.inbox.get()
+    assert message.mark_seen()
+    assert User.get_by_id(user.id).unread_count == 0
+
+    # Marking a message twice should not decrement the counter again
+    assert not message.mark_seen()
+    assert not Inbox.get_by_id(message.id).mark_seen()
+    assert User.get_by_id(user.id).unread_count == 0
+
+    Inbox.create(user_from=User.admin(), user_to=user, subject="hi", body="hello")
+    assert User.get_by_id(user.id).unread_count == 1
+
+
+def test_rate_limiter(frozen_time):
+    rate_limiter = RateLimiter("2/5m")
+    request = SimpleNamespace(environ={"REMOTE_ADDR": "127.0.0.1"})
+    other_request = SimpleNamespace(environ={"REMOTE_ADDR": "127.0.0.2"})
+
+    assert rate_limiter.check(request) is None
+    assert rate_limiter.check(request) is None
+    assert rate_limiter.check(request) is not None
+    assert rate_limiter.check(other_request) is None
+
+    frozen_time.tick(delta=timedelta(minutes=6))
+    assert rate_limiter.check(request) is None
+
+
+def test_rate_limiter_hours(frozen_time):
+    rate_limiter = RateLimiter("2/4h")
+    assert rate_limiter.period == 4 * 60 * 60
+
+    request = SimpleNamespace(environ={"REMOTE_ADDR": "127.0.0.1"})
+    assert rate_limiter.check(request) is None
+    assert rate_limiter.check(request) is None
+
+    frozen_time.tick(delta=timedelta(hours=2))
+    assert rate_limiter.check(request) is not None
+
+    frozen_time.tick(delta=timedelta(hours=2))
+    assert rate_limiter.check(request) is None
+
+
+def test_load_session_expires(frozen_time):
+    session = load_session("session_a")
+    session["alert"] = "hello"
+    assert load_session("session_a") is session
+    assert load_session("session_b") is not session
+
+    frozen_time.tick(delta=timedelta(hours=2))
+    assert load_session("session_a") == {}
+
+
+def test_message_get_count():
+    user = user_factory()
+    Message.reset_count()
+    assert Message.get_count() == 0
+
+    Message.create(user=user, text="hello")
+    Message.reset_count()
+    assert Message.get_count() == 1
+
+
+def test_sync_unread_counts():
+    user = User.initialize(gen_id())
+    User.update(unread_count=5).where(User.id == user.id).execute()
+
+    tasks.sync_unread_counts()
+    assert User.get_by_id(user.id).unread_count == 1
+
+
+def test_app_dispatch():
+    app = AstrobotanyApplication()
+    app.route("/app")(lambda request: "exact")
+    app.route("/app/(?P<page>[0-9]+)")(lambda request, page: f"page {page}")
+    app.route("/app/(?P<page>latest)")(lambda request, page: page)
+    app.route("/app/visit/(?P<user_id>[0-9a-f]+)")(lambda request, user_id: user_id)
+    app.route("/(?P<section>[a-z]+)/about")(lambda request, section: f"about {section}")
+
+    assert app.dispatch(SimpleNamespace(path="/app/")) == "exact"
+    assert app.dispatch(SimpleNamespace(path="/app/12")) == "page 12"
+    assert app.dispatch(SimpleNamespace(path="/app/latest")) == "latest"
+    assert app.dispatch(SimpleNamespace(path="/app/visit/abc")) == "abc"
+    assert app.dispatch(SimpleNamespace(path="/app/about")) == "about app"
+    assert app.dispatch(SimpleNamespace(path="/app/other")).status == 51
+
+
+def test_app_dispatch_precedence():
+    app = AstrobotanyApplication()
+    app.route("/app/news")(lambda request: "exact")
+    app.route("/app/(?P<name>[a-z]+)")(lambda request, name: f"first {name}")
+    app.route("/app/(?P<name>[a-z]+)")(lambda request, name: f"second {name}")
+
+    # Plain paths beat patterns, and later patterns beat earlier ones
+    assert app.dispatch(SimpleNamespace(path="/app/news")) == "exact"
+    assert app.dispatch(SimpleNamespace(path="/app/about")) == "second about"
+
+
+def test_colorize():
+    assert colorize("x") == "x"
+    assert colorize("x", fg=1) == "\033[38;5;16mx\033[0m"
+    assert colorize("x", fg=1, bg=2) == "\033[48;5;17m\033[38;5;16mx\033[0m"
+
+    with pytest.raises(ValueError, match="foreground"):
+        colorize("x", fg=-1)
+    with pytest.raises(ValueError, match="background"):
+        colorize("x", bg=241)
+
+
+def test_item_name_order():
+    names = [item.name for item in items.Item.registry.values()]
+    ordered = sorted(items.Item.registry, key=items.NAME_ORDER.__getitem__)
+    assert [items.Item.registry[item_id].name for item_id in ordered] == sorted(names)
+
+
+def test_rebuild_garden():
+    user = user_factory()
+    plant = user.plant
+    user_without_plant = user_factory()
+
+    data = garden.rebuild_garden()
+    assert data["plain"]
+    assert data["ansi"]
+
+    user = User.get_by_id(user.id)
+    assert user.garden_coordinates
+    assert User.get_by_id(user_without_plant.id).garden_coordinates
+
+    loaded = User.select_with_plant().where(User.id == user.id).get()
+    with count_queries() as counter:
+        assert loaded.plant == plant
+    assert counter.count == 0